@@ -57,6 +57,8 @@ const socket = io(serverUrl, {
 let routingData = [];
 let isGenerating = false;
 let currentModel = 'qwen-1.5-moe-a2.7b';
+// Id of this tab's in-flight generation; updates for other requests are ignored
+let currentRequestId = null;
 
 // DOM elements
 const promptInput = document.getElementById('prompt-input');
@@ -99,8 +101,36 @@ socket.on('disconnect', () => {
   statusElement.textContent = 'Disconnected';
 });
 
-socket.on('routing_update', (data) => {
-  console.log('Received routing update:', data);
+// Typed array constructors for the expert dtypes the server may send
+const EXPERT_ARRAY_TYPES = {
+  uint8: Uint8Array,
+  int16: Int16Array,
+  int64: BigInt64Array,
+};
+
+// Split an update's packed experts into one typed array per token
+function unpackExperts(blob, { dtype, shape, offset }) {
+  const ArrayType = EXPERT_ARRAY_TYPES[dtype];
+  const [rows, topK] = shape;
+  // Copy out so the view is aligned for multi-byte dtypes
+  const values = new ArrayType(blob.slice(offset, offset + rows * topK * ArrayType.BYTES_PER_ELEMENT));
+  const experts = [];
+  for (let row = 0; row < rows; row++) {
+    const rowValues = values.subarray(row * topK, (row + 1) * topK);
+    experts.push(ArrayType === BigInt64Array ? Array.from(rowValues, Number) : rowValues);
+  }
+  return experts;
+}
+
+socket.on('routing_update_batch', (header, experts) => {
+  // The server sends a JSON header plus one blob of packed expert ids
+  const batch = JSON.parse(new TextDecoder().decode(header))
+    .filter(data => data.request_id === currentRequestId);
+  if (batch.length === 0) return;
+  batch.forEach(data => {
+    data.selected_experts = unpackExperts(experts, data.experts);
+  });
+  console.log('Received routing update batch:', batch);
   
   // Check for token display
   if (!tokenDisplay) {
@@ -113,9 +143,11 @@ socket.on('routing_update', (data) => {
     }
   }
   
-  const transformedData = processRoutingData(data);
-  
-  routingData = [...routingData, ...transformedData];
+  // Positions depend on routingData, so merge each update before the next
+  batch.forEach(data => {
+    const transformedData = processRoutingData(data);
+    routingData = [...routingData, ...transformedData];
+  });
   
   clearVisualization();
   createVisualization(routingData);
@@ -199,7 +231,7 @@ function processRoutingData(data) {
       // get experts for this token
       let expertsForToken;
       
-      if (Array.isArray(selectedExperts[0])) {
+      if (Array.isArray(selectedExperts[0]) || ArrayBuffer.isView(selectedExperts[0])) {
         // handle case where experts 2d array
         expertsForToken = selectedExperts[tokenIndex] || [];
       } else {
@@ -249,7 +281,13 @@ function processRoutingData(data) {
   return transformedData;
 }
 
-socket.on('generation_complete', () => {
+socket.on('generated_text', ({ request_id, text }) => {
+  if (request_id !== currentRequestId) return;
+  console.log('Generated text:', text);
+});
+
+socket.on('generation_complete', ({ request_id }) => {
+  if (request_id !== currentRequestId) return;
   isGenerating = false;
   submitButton.disabled = false;
   statusElement.textContent = 'Generation complete';
@@ -282,6 +320,7 @@ async function startGeneration(prompt) {
   submitButton.disabled = true;
   statusElement.textContent = 'Starting generation...';
   
+  currentRequestId = Math.random().toString(36).slice(2) + Date.now().toString(36);
   routingData = [];
   clearVisualization();
   
@@ -303,6 +342,9 @@ async function startGeneration(prompt) {
       body: JSON.stringify({ 
         prompt,
         model: currentModel,
+        request_id: currentRequestId,
+        // Routes this generation's events to this socket only
+        sid: socket.id,
       }),
     });
     
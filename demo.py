@@ -1,6 +1,4 @@
-import time
 import torch
-import torch.nn.functional as F
 
 from collections import deque
 from torch import nn
@@ -14,24 +12,24 @@ scratch = deque()
 def get_experts(layer_id):
 
     def hook(module, input, output):
-        selected_experts = process_router_logits(output.clone().detach(), top_k=4)
+        selected_experts = process_router_logits(output, top_k=4)
         tokens = scratch.popleft()
-        experts_list.append((layer_id, tokens, selected_experts.cpu()))
+        experts_list.append((layer_id, tokens, selected_experts.to(torch.uint8).to('cpu', non_blocking=True)))
 
     return hook
 
 
 def process_router_logits(router_logits, top_k):
     # router_logits: (batch * sequence_length, n_experts)
-    routing_weights = F.softmax(router_logits, dim=1, dtype=torch.float)
-    routing_weights, selected_experts = torch.topk(routing_weights, top_k, dim=-1)
-    return selected_experts
+    # softmax is monotonic, so topk on the logits selects the same experts
+    return torch.topk(router_logits, top_k, dim=-1).indices
 
 
 def get_token():
 
     def hook(module, input):
-        scratch.append(input[0].clone().detach().cpu())
+        # non-blocking: results are only read after the final synchronize
+        scratch.append(input[0].to('cpu', non_blocking=True))
     
     return hook
 
@@ -66,16 +64,18 @@ text = tokenizer.apply_chat_template(
 model_inputs = tokenizer([text], return_tensors="pt").to(model.device)
 # print(model_inputs.input_ids.shape)
 
+start = torch.cuda.Event(enable_timing=True)
+end = torch.cuda.Event(enable_timing=True)
+start.record()
+with torch.inference_mode():
+    generated_ids = model.generate(
+        **model_inputs,
+        max_new_tokens=512
+    )
+end.record()
 torch.cuda.synchronize()
-t1 = time.time()
-generated_ids = model.generate(
-    **model_inputs,
-    max_new_tokens=512
-)
-torch.cuda.synchronize()
-t2 = time.time()
 
-print(f"runtime: {t2 - t1}")
+print(f"runtime: {start.elapsed_time(end) / 1000}")
 
 # print(generated_ids)
 # print(generated_ids.shape)
@@ -31,11 +31,26 @@ MODEL_CONFIGS: Dict[str, Dict[str, Any]] = {
     },
 }
 
+# Attention kernels for loaded models: "sdpa" or "flash_attention_2" (requires flash-attn)
+ATTN_IMPLEMENTATION = os.environ.get("MOEVIZ_ATTN_IMPLEMENTATION", "sdpa")
+
+# Models kept resident at once; the least recently used one is unloaded
+MAX_LOADED_MODELS = int(os.environ.get("MOEVIZ_MAX_LOADED_MODELS", "1"))
+
+# Weight quantization for loaded models: "", "4bit" or "8bit" (requires bitsandbytes).
+# A model config's 'quantization' key overrides this.
+QUANTIZATION = os.environ.get("MOEVIZ_QUANTIZATION", "").lower()
+
 # Generation settings
 MAX_NEW_TOKENS = int(os.environ.get("MOEVIZ_MAX_NEW_TOKENS", "128"))
+# Max routing updates coalesced into one socket.io message
+ROUTING_BATCH_SIZE = int(os.environ.get("MOEVIZ_ROUTING_BATCH_SIZE", "32"))
+# Decode steps collected on the GPU before one host copy; 1 sends every step
+ROUTING_FLUSH_STEPS = int(os.environ.get("MOEVIZ_ROUTING_FLUSH_STEPS", "1"))
 
 # Advanced settings
-THREAD_POOL_WORKERS = int(os.environ.get("MOEVIZ_THREAD_POOL_WORKERS", "1"))
+ROUTE_PROMPT_TOKENS = os.environ.get("MOEVIZ_ROUTE_PROMPT_TOKENS", "true").lower() == "true"
+COMPILE_ROUTER = os.environ.get("MOEVIZ_COMPILE_ROUTER", "false").lower() == "true"
 
 def get_client_config() -> Dict[str, Any]:
     """Return configuration values needed by the client"""
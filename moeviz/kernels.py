@@ -0,0 +1,111 @@
+"""Custom kernels for router post-processing."""
+
+import torch
+from typing import Tuple
+
+try:
+    import triton
+    import triton.language as tl
+except ImportError:
+    triton = None
+
+
+if triton is not None:
+    @triton.jit
+    def _router_topk_kernel(logits_ptr, out_val_ptr, out_idx_ptr, n_experts, stride_row,
+                            TOP_K: tl.constexpr, BLOCK: tl.constexpr):
+        """Select the top_k experts of one token's router logits.
+
+        One program handles one row. The row stays in registers and the k
+        maxima are found by repeated max + mask, which beats a sort for the
+        small k used by MoE routers.
+        """
+        row = tl.program_id(0)
+        offsets = tl.arange(0, BLOCK)
+        mask = offsets < n_experts
+        logits = tl.load(logits_ptr + row * stride_row + offsets, mask=mask, other=float('-inf'))
+        logits = logits.to(tl.float32)
+
+        for i in tl.static_range(TOP_K):
+            value = tl.max(logits, axis=0)
+            index = tl.argmax(logits, axis=0)
+            tl.store(out_val_ptr + row * TOP_K + i, value)
+            tl.store(out_idx_ptr + row * TOP_K + i, index)
+            logits = tl.where(offsets == index, float('-inf'), logits)
+
+
+TRITON_AVAILABLE = triton is not None
+
+
+def _launch_router_topk(router_logits: torch.Tensor, values: torch.Tensor, indices: torch.Tensor) -> None:
+    """Run the Triton top-k kernel into (n_rows, top_k) output tensors."""
+    n_experts = router_logits.shape[-1]
+    logits = router_logits.reshape(-1, n_experts).contiguous()
+    n_rows = logits.shape[0]
+    if n_rows > 0:
+        # Triton launches on the current device's stream; with device_map="auto"
+        # the router may live on another GPU, whose stream later host copies
+        # are ordered on
+        with torch.cuda.device(router_logits.device):
+            _router_topk_kernel[(n_rows,)](
+                logits, values, indices, n_experts, logits.stride(0),
+                TOP_K=values.shape[-1], BLOCK=triton.next_power_of_2(n_experts),
+            )
+
+
+@torch.library.custom_op("moeviz::router_topk", mutates_args=())
+def router_topk(router_logits: torch.Tensor, top_k: int,
+                index_dtype: torch.dtype) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Top-k over the last dimension of router logits.
+
+    Runs a fused Triton kernel on CUDA and falls back to torch.topk
+    elsewhere. Registered as a custom op so it composes with torch.compile.
+
+    Args:
+        router_logits: Logits of shape (..., n_experts)
+        top_k: Number of experts to select per token
+        index_dtype: Integer dtype of the returned indices; the kernel writes
+            it directly so no separate cast is launched
+
+    Returns:
+        Tuple of (values, indices), each of shape (..., top_k)
+    """
+    if triton is None or not router_logits.is_cuda:
+        values, indices = torch.topk(router_logits, top_k, dim=-1)
+        return values, indices.to(index_dtype)
+
+    n_rows = router_logits.numel() // router_logits.shape[-1]
+    values = torch.empty((n_rows, top_k), dtype=router_logits.dtype, device=router_logits.device)
+    indices = torch.empty((n_rows, top_k), dtype=index_dtype, device=router_logits.device)
+    _launch_router_topk(router_logits, values, indices)
+
+    out_shape = router_logits.shape[:-1] + (top_k,)
+    return values.view(out_shape), indices.view(out_shape)
+
+
+@router_topk.register_fake
+def _(router_logits: torch.Tensor, top_k: int,
+      index_dtype: torch.dtype) -> Tuple[torch.Tensor, torch.Tensor]:
+    out_shape = router_logits.shape[:-1] + (top_k,)
+    return (router_logits.new_empty(out_shape),
+            router_logits.new_empty(out_shape, dtype=index_dtype))
+
+
+@torch.library.custom_op("moeviz::router_topk_out", mutates_args=("values", "indices"))
+def router_topk_out(router_logits: torch.Tensor, values: torch.Tensor, indices: torch.Tensor) -> None:
+    """Top-k of router logits written into preallocated outputs.
+
+    Lets callers reuse the same output tensors across forward passes instead
+    of allocating per call. Requires CUDA and Triton.
+
+    Args:
+        router_logits: Logits of shape (..., n_experts)
+        values: Output of shape (n_rows, top_k) in the logits' dtype
+        indices: Output of shape (n_rows, top_k) in any integer dtype
+    """
+    _launch_router_topk(router_logits, values, indices)
+
+
+@router_topk_out.register_fake
+def _(router_logits: torch.Tensor, values: torch.Tensor, indices: torch.Tensor) -> None:
+    return None
@@ -1,22 +1,98 @@
 """Model adapters for different MoE architectures."""
 
+import contextlib
+import functools
+import logging
+import re
 import torch
-import torch.nn.functional as F
-from typing import Any, Dict, List, Tuple, Optional, Union, Callable
+import weakref
+from typing import Any, Dict, Iterator, List, Tuple, Optional, Union, Callable
+
+from moeviz.kernels import TRITON_AVAILABLE, router_topk, router_topk_out
+
+
+logger = logging.getLogger(__name__)
+
+
+# model -> {path: module}; weak so unloaded models are not kept alive
+_resolved_modules: "weakref.WeakKeyDictionary[Any, Dict[str, Any]]" = weakref.WeakKeyDictionary()
+
+_PATH_RE = re.compile(r'[^.\[\]]+(?:\.[^.\[\]]+|\[-?\d+\])*')
+_PATH_PART_RE = re.compile(r'\[(-?\d+)\]|([^.\[\]]+)')
+
+
+@functools.lru_cache(maxsize=128)
+def _parse_path(path: str) -> Tuple[Union[str, int], ...]:
+    """Split a module path like model.layers[0].mlp.gate into its parts.
+    
+    Args:
+        path: Dotted path, optionally with integer indexing
+        
+    Returns:
+        Tuple of attribute names (str) and indices (int)
+        
+    Raises:
+        ValueError: If the path is not a dotted path with integer indices
+    """
+    if not _PATH_RE.fullmatch(path):
+        raise ValueError(f"Invalid module path: {path}")
+    return tuple(int(index) if index else name
+                 for index, name in _PATH_PART_RE.findall(path))
+
+
+def decode_tokens(tokenizer: Any, tokens: Union[List[int], int]) -> List[str]:
+    """Decode token ids into their individual string pieces.
+    
+    Uses a single batch_decode call so the tokenizer backend is entered
+    once per routing update rather than once per token.
+    
+    Args:
+        tokenizer: Tokenizer used for decoding
+        tokens: Token id or list of token ids
+        
+    Returns:
+        List with one decoded string per token
+    """
+    if not isinstance(tokens, list):
+        tokens = [tokens]
+    try:
+        return tokenizer.batch_decode([[int(t)] for t in tokens])
+    except Exception as e:
+        logger.warning("Error decoding tokens: %s", e)
+        return [f"[ERROR:{t}]" for t in tokens]
 
 
 class ModelAdapter:
     """Base class for model-specific router and token handlers."""
     
-    def __init__(self, config: Dict[str, Any]):
+    def __init__(self, config: Dict[str, Any], include_prompt: bool = True, flush_steps: int = 1):
         """Initialize adapter with model configuration.
         
         Args:
             config: Configuration dict with router_type, top_k, etc.
+            include_prompt: Whether to report routing for every prompt token
+                during prefill, or only for the last position
+            flush_steps: Number of decode steps collected on device before
+                they are copied to the host as one routing update
         """
         self.config = config
+        self.include_prompt = include_prompt
+        self.flush_steps = flush_steps
         self.top_k = config.get('top_k', 2)
         self.model_type = config.get('model_type', 'unknown')
+        # Narrowest integer type that holds every expert id, so the host copy
+        # and serialization move 1-2 bytes per id instead of 8
+        expert_count = config.get('expert_count')
+        if expert_count is None:
+            self.expert_id_dtype = torch.int64
+        elif expert_count <= 256:
+            self.expert_id_dtype = torch.uint8
+        else:
+            self.expert_id_dtype = torch.int16
+        # (n_rows, device, dtype) -> (values, indices) top-k output buffers
+        self._topk_buffers: Dict[Tuple[int, torch.device, torch.dtype], Tuple[torch.Tensor, torch.Tensor]] = {}
+        # layer_id -> on-device ring of decode steps not yet copied to the host
+        self._windows: Dict[int, Dict[str, Any]] = {}
     
     def get_router_path(self, layer_id: int) -> str:
         """Get the path to the router module for a specific layer.
@@ -40,84 +116,162 @@ class ModelAdapter:
         Returns:
             The resolved module
         """
-        # Handle special case with indexing like model.layers[0].mlp.gate
-        if '[' in path and ']' in path:
-            parts = []
-            current = ""
-            i = 0
-            while i < len(path):
-                if path[i] == '[':
-                    if current:
-                        parts.append(current)
-                        current = ""
-                    # Find the matching closing bracket
-                    j = i + 1
-                    bracket_content = ""
-                    while j < len(path) and path[j] != ']':
-                        bracket_content += path[j]
-                        j += 1
-                    if j < len(path):  # Found the closing bracket
-                        # Evaluate the content inside brackets
-                        index = eval(bracket_content)
-                        parts.append(lambda obj, idx=index: obj[idx])
-                        i = j + 1
-                    else:
-                        # No matching bracket found
-                        current += path[i]
-                        i += 1
-                elif path[i] == '.':
-                    if current:
-                        parts.append(current)
-                        current = ""
-                    i += 1
-                else:
-                    current += path[i]
-                    i += 1
-            
-            if current:
-                parts.append(current)
-            
-            # Resolve the path
+        modules = _resolved_modules.setdefault(model, {})
+        if path not in modules:
             obj = model
-            for part in parts:
-                if callable(part):
-                    obj = part(obj)
-                else:
-                    obj = getattr(obj, part)
-            return obj
-        else:
-            # Simple dotted path
-            obj = model
-            for part in path.split('.'):
-                obj = getattr(obj, part)
-            return obj
+            for part in _parse_path(path):
+                obj = obj[part] if isinstance(part, int) else getattr(obj, part)
+            modules[path] = obj
+        return modules[path]
+    
+    def compile_router(self, model: Any, layer_id: int) -> None:
+        """Replace the router module for a layer with a torch.compile'd one.
+        
+        Uses reduce-overhead mode so the small gate projection replays as a
+        CUDA graph instead of launching its kernels individually. Must be
+        called before hooks are registered on the router.
+        
+        Args:
+            model: The model containing the router
+            layer_id: Index of the layer whose router is compiled
+        """
+        router_path = self.get_router_path(layer_id)
+        router = self.resolve_module_path(model, router_path)
+        # Already compiled on an earlier request
+        if hasattr(router, '_orig_mod'):
+            return
+        
+        *parent_path, name = _parse_path(router_path)
+        parent = model
+        for part in parent_path:
+            parent = parent[part] if isinstance(part, int) else getattr(parent, part)
+        compiled = torch.compile(router, mode='reduce-overhead')
+        setattr(parent, name, compiled)
+        _resolved_modules[model][router_path] = compiled
     
     def get_token_hook(self, token_queue: Any) -> Callable:
         """Create a hook for capturing input tokens. Shared across all adapters.
         
         Args:
-            token_queue: Queue to put tokens into
+            token_queue: Deque to append token tensors to
             
         Returns:
             A hook function that can be registered with register_forward_pre_hook
         """
         def hook(module, input):
-            tokens = input[0].clone().detach().cpu().squeeze().tolist()
-            # Ensure tokens is always a list
-            if not isinstance(tokens, list):
-                tokens = [tokens]
-            token_queue.put(tokens)
+            # Flattened so the consumer always gets a list from tolist()
+            tokens = input[0].reshape(-1)
+            if not self.include_prompt:
+                tokens = tokens[-1:]
+            token_queue.append(tokens)
         
         return hook
     
-    def get_router_hook(self, layer_id: int, token_queue: Any, routing_queue: Any, tokenizer: Any = None) -> Callable:
+    def _copy_to_host(self, tensor: torch.Tensor) -> Tuple[torch.Tensor, Optional[Any]]:
+        """Start a non-blocking device-to-host copy of a tensor.
+        
+        The copy lands in pinned memory (served by torch's caching host
+        allocator) so the hook does not synchronize with the device. The
+        consumer must wait on the returned event before reading the result.
+        
+        Args:
+            tensor: Tensor to copy, on any device
+            
+        Returns:
+            Tuple of (host tensor, CUDA event or None for CPU tensors)
+        """
+        if not tensor.is_cuda:
+            # Copied anyway since the source may be a reused buffer
+            return tensor.clone(), None
+        host = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+        # Issue the copy and record the event on the tensor's own device; with
+        # device_map="auto" a router can live on a GPU other than the current one
+        with torch.cuda.device(tensor.device):
+            host.copy_(tensor, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record()
+        return host, event
+    
+    def _put_routing(self, layer_id: int, tokens: torch.Tensor, selected_experts: torch.Tensor,
+                     routing_queue: Any) -> None:
+        """Start the host copies of routing data and queue it.
+        
+        Args:
+            layer_id: Index of the layer
+            tokens: Token ids, on the model's device
+            selected_experts: Selected experts per token, on the model's device
+            routing_queue: Queue to put routing data into
+        """
+        host_tokens, tokens_event = self._copy_to_host(tokens)
+        host_experts, experts_event = self._copy_to_host(selected_experts)
+        
+        # Tensors are still in flight; the consumer waits on copy_events
+        # before reading them
+        routing_queue.put({
+            "layer_id": layer_id,
+            "tokens": host_tokens,
+            "selected_experts": host_experts,
+            "copy_events": [e for e in (tokens_event, experts_event) if e is not None],
+        })
+    
+    def _record_routing(self, layer_id: int, tokens: torch.Tensor, selected_experts: torch.Tensor,
+                        routing_queue: Any) -> None:
+        """Queue routing data for one forward pass.
+        
+        With flush_steps > 1, single-token decode steps are written into an
+        on-device ring and copied to the host once per window, amortizing the
+        per-transfer cost. Prefill passes flush the ring and go out directly.
+        
+        Args:
+            layer_id: Index of the layer
+            tokens: Token ids, on the model's device
+            selected_experts: Selected experts per token, on the model's device
+            routing_queue: Queue to put routing data into
+        """
+        if self.flush_steps <= 1 or tokens.numel() != 1:
+            self._flush_window(layer_id, routing_queue)
+            self._put_routing(layer_id, tokens, selected_experts, routing_queue)
+            return
+        
+        window = self._windows.get(layer_id)
+        if window is None:
+            window = self._windows[layer_id] = {
+                "tokens": torch.empty(self.flush_steps, dtype=tokens.dtype, device=tokens.device),
+                "experts": torch.empty((self.flush_steps, self.top_k), dtype=selected_experts.dtype,
+                                       device=selected_experts.device),
+                "count": 0,
+            }
+        step = window["count"]
+        window["tokens"][step:step + 1].copy_(tokens)
+        window["experts"][step:step + 1].copy_(selected_experts.reshape(1, -1))
+        window["count"] = step + 1
+        if window["count"] == self.flush_steps:
+            self._flush_window(layer_id, routing_queue)
+    
+    def _flush_window(self, layer_id: int, routing_queue: Any) -> None:
+        """Queue the decode steps collected for a layer, if any.
+        
+        The ring is reused right away; on CUDA its next writes are ordered on
+        the stream after the pending host copy.
+        
+        Args:
+            layer_id: Index of the layer
+            routing_queue: Queue to put routing data into
+        """
+        window = self._windows.get(layer_id)
+        if window is None or window["count"] == 0:
+            return
+        count = window["count"]
+        self._put_routing(layer_id, window["tokens"][:count], window["experts"][:count], routing_queue)
+        window["count"] = 0
+    
+    def get_router_hook(self, layer_id: int, token_queue: Any, routing_queue: Any) -> Callable:
         """Create a hook for capturing router information.
         
         Args:
             layer_id: Index of the layer
-            token_queue: Queue to get tokens from
+            token_queue: Deque to pop token tensors from
             routing_queue: Queue to put routing data into
-            tokenizer: Optional tokenizer for decoding tokens
             
         Returns:
             A hook function that can be registered with register_forward_hook
@@ -133,20 +287,56 @@ class ModelAdapter:
         Returns:
             Tensor of selected experts
         """
-        # Default implementation for most models
-        routing_weights = F.softmax(router_logits, dim=-1, dtype=torch.float)
-        routing_weights, selected_experts = torch.topk(routing_weights, self.top_k, dim=-1)
-        return selected_experts
+        # Prefill covers every prompt position; decode steps are a single row
+        if not self.include_prompt:
+            router_logits = router_logits[-1:]
+        
+        # Softmax is monotonic, so topk over the raw logits selects the same
+        # experts as topk over the probabilities. Only indices are needed here;
+        # if weights are ever required, softmax the k topk values instead.
+        if not (TRITON_AVAILABLE and router_logits.is_cuda):
+            _, selected_experts = router_topk(router_logits, self.top_k, self.expert_id_dtype)
+            return selected_experts
+        
+        # Reuse output buffers per shape: prefill allocates once and every
+        # decode step shares one pair. Reuse is safe because later writes are
+        # ordered on the stream after the pending device-to-host copy.
+        n_rows = router_logits.numel() // router_logits.shape[-1]
+        key = (n_rows, router_logits.device, router_logits.dtype)
+        if key not in self._topk_buffers:
+            self._topk_buffers[key] = (
+                torch.empty((n_rows, self.top_k), dtype=router_logits.dtype, device=router_logits.device),
+                torch.empty((n_rows, self.top_k), dtype=self.expert_id_dtype, device=router_logits.device),
+            )
+        values, selected_experts = self._topk_buffers[key]
+        router_topk_out(router_logits, values, selected_experts)
+        return selected_experts.view(router_logits.shape[:-1] + (self.top_k,))
     
-    def register_hooks(self, model: Any, layer_id: int, token_queue: Any, routing_queue: Any, tokenizer: Any = None) -> List[Any]:
+    def warmup(self, device: Any, dtype: torch.dtype) -> None:
+        """Run expert selection once so kernels are compiled before generation.
+        
+        The Triton top-k kernel is JIT-compiled on first use; doing that at
+        model load keeps the compile out of the first request's latency.
+        
+        Args:
+            device: Device the router logits live on
+            dtype: Dtype of the router logits
+        """
+        expert_count = self.config.get('expert_count')
+        if expert_count is None:
+            return
+        router_logits = torch.zeros((1, expert_count), device=device, dtype=dtype)
+        with torch.inference_mode():
+            self.process_router_logits(router_logits)
+    
+    def register_hooks(self, model: Any, layer_id: int, token_queue: Any, routing_queue: Any) -> List[Any]:
         """Register all necessary hooks for the model.
         
         Args:
             model: The model to hook
             layer_id: Index of the layer to hook
-            token_queue: Queue for tokens
+            token_queue: Deque for tokens
             routing_queue: Queue for routing data
-            tokenizer: Optional tokenizer for decoding tokens
             
         Returns:
             List of hook handles
@@ -161,55 +351,48 @@ class ModelAdapter:
         # Get router hook for specific layer
         router_path = self.get_router_path(layer_id)
         router_module = self.resolve_module_path(model, router_path)
-        router_hook = self.get_router_hook(layer_id, token_queue, routing_queue, tokenizer)
+        router_hook = self.get_router_hook(layer_id, token_queue, routing_queue)
         router_hook_handle = router_module.register_forward_hook(router_hook)
         hooks.append(router_hook_handle)
         
         return hooks
+    
+    @contextlib.contextmanager
+    def hooks_registered(self, model: Any, layer_id: int, token_queue: Any, routing_queue: Any) -> Iterator[List[Any]]:
+        """Register hooks for the duration of a with block.
+        
+        Hooks are removed on exit even if generation raises, so repeated
+        requests never stack duplicate hooks on the model.
+        
+        Args:
+            model: The model to hook
+            layer_id: Index of the layer to hook
+            token_queue: Deque for tokens
+            routing_queue: Queue for routing data
+            
+        Yields:
+            List of hook handles
+        """
+        hooks = self.register_hooks(model, layer_id, token_queue, routing_queue)
+        try:
+            yield hooks
+        finally:
+            for hook in hooks:
+                hook.remove()
+            # Send decode steps still waiting in a partial window
+            for window_layer_id in self._windows:
+                self._flush_window(window_layer_id, routing_queue)
 
 
 class QwenMoEAdapter(ModelAdapter):
     """Adapter for Qwen MoE models."""
     
-    def get_router_hook(self, layer_id: int, token_queue: Any, routing_queue: Any, tokenizer: Any = None) -> Callable:
+    def get_router_hook(self, layer_id: int, token_queue: Any, routing_queue: Any) -> Callable:
         """Create router hook for Qwen models."""
         def hook(module, input, output):
-            selected_experts = self.process_router_logits(output.clone().detach())
-            tokens = token_queue.get()
-            
-            routing_data = {
-                "layer_id": layer_id,
-                "tokens": tokens,
-                "selected_experts": selected_experts.cpu().tolist(),
-            }
-            
-            # Add decoded tokens if tokenizer is available
-            if tokenizer is not None:
-                try:
-                    if isinstance(tokens, list):
-                        # Make sure to convert tokens to integers for decoding
-                        decoded_tokens = []
-                        for t in tokens:
-                            try:
-                                token_str = tokenizer.decode([int(t)])
-                                decoded_tokens.append(token_str)
-                            except Exception as e:
-                                print(f"Error decoding token {t}: {e}")
-                                decoded_tokens.append(f"[ERROR:{t}]")
-                    else:
-                        try:
-                            decoded_tokens = [tokenizer.decode([int(tokens)])]
-                        except:
-                            decoded_tokens = [f"[ERROR:{tokens}]"]
-                    
-                    routing_data["decoded_tokens"] = decoded_tokens
-                    print(f"Successfully decoded {len(decoded_tokens)} tokens")
-                except Exception as e:
-                    print(f"Error decoding tokens: {e}")
-                    print(f"Token type: {type(tokens)}")
-                    print(f"Token value: {tokens}")
-            
-            routing_queue.put(routing_data)
+            selected_experts = self.process_router_logits(output)
+            tokens = token_queue.popleft()
+            self._record_routing(layer_id, tokens, selected_experts, routing_queue)
         
         return hook
 
@@ -217,7 +400,7 @@ class QwenMoEAdapter(ModelAdapter):
 class MixtralAdapter(ModelAdapter):
     """Adapter for Mixtral 8x7B models."""
     
-    def get_router_hook(self, layer_id: int, token_queue: Any, routing_queue: Any, tokenizer: Any = None) -> Callable:
+    def get_router_hook(self, layer_id: int, token_queue: Any, routing_queue: Any) -> Callable:
         """Create router hook for Mixtral models."""
         def hook(module, input, output):
             # Mixtral returns router probs and router logits
@@ -225,51 +408,21 @@ class MixtralAdapter(ModelAdapter):
             if hasattr(output, "router_logits"):
                 router_logits = output.router_logits
             
-            selected_experts = self.process_router_logits(router_logits.clone().detach())
-            tokens = token_queue.get()
-            
-            routing_data = {
-                "layer_id": layer_id,
-                "tokens": tokens,
-                "selected_experts": selected_experts.cpu().tolist(),
-            }
-            
-            # Add decoded tokens if tokenizer is available
-            if tokenizer is not None:
-                try:
-                    if isinstance(tokens, list):
-                        # Make sure to convert tokens to integers for decoding
-                        decoded_tokens = []
-                        for t in tokens:
-                            try:
-                                token_str = tokenizer.decode([int(t)])
-                                decoded_tokens.append(token_str)
-                            except Exception as e:
-                                print(f"Error decoding token {t}: {e}")
-                                decoded_tokens.append(f"[ERROR:{t}]")
-                    else:
-                        try:
-                            decoded_tokens = [tokenizer.decode([int(tokens)])]
-                        except:
-                            decoded_tokens = [f"[ERROR:{tokens}]"]
-                    
-                    routing_data["decoded_tokens"] = decoded_tokens
-                    print(f"Successfully decoded {len(decoded_tokens)} tokens")
-                except Exception as e:
-                    print(f"Error decoding tokens: {e}")
-                    print(f"Token type: {type(tokens)}")
-                    print(f"Token value: {tokens}")
-            
-            routing_queue.put(routing_data)
+            selected_experts = self.process_router_logits(router_logits)
+            tokens = token_queue.popleft()
+            self._record_routing(layer_id, tokens, selected_experts, routing_queue)
         
         return hook
 
 
-def get_model_adapter(model_config: Dict[str, Any]) -> ModelAdapter:
+def get_model_adapter(model_config: Dict[str, Any], include_prompt: bool = True,
+                      flush_steps: int = 1) -> ModelAdapter:
     """Factory function to get the appropriate adapter for a model.
     
     Args:
         model_config: Configuration dict for the model
+        include_prompt: Whether to report routing for every prompt token
+        flush_steps: Decode steps batched into one host copy
         
     Returns:
         An appropriate ModelAdapter instance
@@ -280,8 +433,8 @@ def get_model_adapter(model_config: Dict[str, Any]) -> ModelAdapter:
     model_type = model_config.get('model_type', '').lower()
     
     if model_type == 'qwen':
-        return QwenMoEAdapter(model_config)
+        return QwenMoEAdapter(model_config, include_prompt, flush_steps)
     elif model_type == 'mixtral':
-        return MixtralAdapter(model_config)
+        return MixtralAdapter(model_config, include_prompt, flush_steps)
     else:
         raise ValueError(f"No adapter available for model type: {model_type}")
\ No newline at end of file
@@ -1,29 +1,42 @@
 import asyncio
+import gc
 import json
+import orjson
 import socketio
-import torch
-import torch.nn.functional as F
+import uuid
 import uvicorn
 
+from collections import OrderedDict, deque
 from concurrent.futures import ThreadPoolExecutor
 from fastapi import FastAPI, Request, Body
 from fastapi.middleware.cors import CORSMiddleware
-from queue import Queue
 from pydantic import BaseModel
-from transformers import AutoModelForCausalLM, AutoTokenizer
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional
 
 from moeviz.config import (SERVER_HOST, SERVER_PORT, ENABLE_CORS, MODEL_CONFIGS, 
-                          MAX_NEW_TOKENS, THREAD_POOL_WORKERS, get_client_config)
-from moeviz.model_adapters import get_model_adapter
+                          MAX_NEW_TOKENS, COMPILE_ROUTER,
+                          ROUTE_PROMPT_TOKENS, ROUTING_BATCH_SIZE, ROUTING_FLUSH_STEPS, QUANTIZATION,
+                          MAX_LOADED_MODELS, ATTN_IMPLEMENTATION, get_client_config)
+
+# torch, transformers and the model adapters (which pull in torch) are
+# imported where they are first needed, so the server binds its port and
+# serves /config without paying for them
 
 
 class GenerateRequest(BaseModel):
     prompt: str
     model: str
+    # Tags this request's socket.io events; generated by the server if omitted
+    request_id: Optional[str] = None
+    # Socket.io session that receives this request's events; none are sent
+    # if omitted
+    sid: Optional[str] = None
 
 
-thread_pool = ThreadPoolExecutor(max_workers=THREAD_POOL_WORKERS)
+# One dedicated worker drives the GPU; concurrent generations on the same
+# device would only contend on the default CUDA stream
+GPU_WORKERS = 1
+thread_pool = ThreadPoolExecutor(max_workers=GPU_WORKERS, thread_name_prefix='gen-gpu0')
 
 
 app = FastAPI()
@@ -37,48 +50,223 @@ if ENABLE_CORS:
         allow_headers=["*"],
     )
 
-sio = socketio.AsyncServer(async_mode='asgi', cors_allowed_origins='*')
+class OrjsonSerializer:
+    """Drop-in for the json module used by socketio, backed by orjson.
+    
+    Encodes and decodes the socket.io and engine.io packet framing; routing
+    payloads are already bytes and travel as binary attachments.
+    """
+    
+    @staticmethod
+    def dumps(obj: Any, **kwargs) -> str:
+        return orjson.dumps(obj).decode()
+    
+    @staticmethod
+    def loads(s: Any, **kwargs) -> Any:
+        return orjson.loads(s)
+
+
+sio = socketio.AsyncServer(async_mode='asgi', cors_allowed_origins='*', json=OrjsonSerializer)
 socket_app = socketio.ASGIApp(sio)
 
 app.mount("/socket.io", socket_app)
 
 
-tokens_queue = Queue()
-routing_queue = Queue()
+class RoutingBuffer:
+    """Routing updates written by the generation thread, drained on the event loop.
+    
+    Hooks append to a deque, which is atomic under the GIL, and only wake
+    the loop with call_soon_threadsafe when the consumer may be waiting, so
+    a burst of updates costs one wakeup instead of one per update.
+    """
+    
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.items = deque()
+        self.loop = loop
+        self.ready = asyncio.Event()
+    
+    def put(self, item: Any) -> None:
+        self.items.append(item)
+        # Appended before the check, so a consumer that has already cleared
+        # the event still sees this item on its next drain
+        if not self.ready.is_set():
+            self.loop.call_soon_threadsafe(self.ready.set)
+    
+    async def get_batch(self, max_items: int) -> List[Any]:
+        while not self.items:
+            await self.ready.wait()
+            self.ready.clear()
+        batch = []
+        while self.items and len(batch) < max_items:
+            batch.append(self.items.popleft())
+        return batch
+    
+
+
+class RequestRoutingWriter:
+    """Tags routing updates from one request's hooks before buffering them."""
+    
+    def __init__(self, buffer: RoutingBuffer, request_id: str, sid: Optional[str], tokenizer: Any):
+        self.buffer = buffer
+        self.request_id = request_id
+        self.sid = sid
+        self.tokenizer = tokenizer
+    
+    def put(self, item: Any) -> None:
+        # Nobody to send it to
+        if self.sid is None:
+            return
+        item["request_id"] = self.request_id
+        # Used to route and decode the update, removed before serialization
+        item["sid"] = self.sid
+        item["tokenizer"] = self.tokenizer
+        self.buffer.put(item)
+
+
+# Created in startup_event so it binds to the running loop
+routing_buffer: RoutingBuffer = None
+
+# Admits one generation per GPU worker. With a single worker this also keeps
+# requests from hooking a shared model while another generation is using it
+generation_semaphore = asyncio.Semaphore(GPU_WORKERS)
+
+def encode_routing_batch(batch):
+    """Finish a batch of routing updates and serialize it for the wire.
+    
+    Runs on a worker thread: waits for the hooks' async device-to-host
+    copies, decodes the tokens, and encodes the payload so none of this work
+    lands on the event loop. Returns a JSON header and one binary blob with
+    every update's selected experts packed in their compact integer dtype;
+    each header entry records where its experts sit in the blob.
+    """
+    from moeviz.model_adapters import decode_tokens
+    
+    expert_chunks = []
+    offset = 0
+    for data in batch:
+        for copy_event in data.pop("copy_events"):
+            copy_event.synchronize()
+        data["tokens"] = data["tokens"].tolist()
+        experts = data.pop("selected_experts").numpy()
+        experts = experts.reshape(-1, experts.shape[-1])
+        data["experts"] = {
+            "dtype": experts.dtype.name,
+            "shape": experts.shape,
+            "offset": offset,
+        }
+        expert_chunks.append(experts.tobytes())
+        offset += experts.nbytes
+        tokenizer = data.pop("tokenizer")
+        if tokenizer is not None:
+            data["decoded_tokens"] = decode_tokens(tokenizer, data["tokens"])
+    return orjson.dumps(batch), b"".join(expert_chunks)
 
 async def process_routing_queue():
     while True:
-        if not routing_queue.empty():
-            data = routing_queue.get()
-            await sio.emit('routing_update', data)
-        await asyncio.sleep(0.001)
+        # Coalesce what is already queued, up to a cap, into a single emit
+        batch = await routing_buffer.get_batch(ROUTING_BATCH_SIZE)
+        
+        # Only the client that made a request receives its updates
+        batches_by_sid = {}
+        for data in batch:
+            batches_by_sid.setdefault(data.pop("sid"), []).append(data)
+        
+        for sid, sid_batch in batches_by_sid.items():
+            # Default executor, not thread_pool where it would queue behind generation
+            header, experts = await asyncio.to_thread(encode_routing_batch, sid_batch)
+            # Sent as binary attachments so socketio does not re-encode them
+            await sio.emit('routing_update_batch', (header, experts), to=sid)
 
 @app.on_event("startup")
 async def startup_event():
+    global routing_buffer
     print("starting up and creating task")
+    routing_buffer = RoutingBuffer(asyncio.get_running_loop())
     asyncio.create_task(process_routing_queue())
 
 
 # Model configurations are now imported from config.py
 
-loaded_models = {}
+# Least recently used first
+loaded_models: "OrderedDict[str, tuple]" = OrderedDict()
+
+def evict_models(max_models):
+    """Unload least recently used models until at most max_models remain."""
+    if len(loaded_models) <= max_models:
+        return
+    while len(loaded_models) > max_models:
+        # Delete without binding the entry, which would keep the last evicted
+        # model alive through the collection below
+        model_id = next(iter(loaded_models))
+        del loaded_models[model_id]
+        print(f"Unloading model {model_id}")
+    # Weights are only freed once collected; then hand the cached blocks back
+    gc.collect()
+    import torch
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+def get_quantization_config(quantization):
+    """Return a bitsandbytes config for '4bit' or '8bit', or None to load unquantized."""
+    if not quantization:
+        return None
+    import torch
+    from transformers import BitsAndBytesConfig
+    if quantization == "4bit":
+        return BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_compute_dtype=torch.bfloat16,
+            bnb_4bit_use_double_quant=True
+        )
+    if quantization == "8bit":
+        return BitsAndBytesConfig(load_in_8bit=True)
+    raise ValueError(f"Unknown quantization: {quantization}")
 
 def load_model(model_id):
-    """Load a model and tokenizer by model_id from MODEL_CONFIGS."""
+    """Load a model and tokenizer by model_id from MODEL_CONFIGS.
+    
+    May evict other models, so callers must hold generation_semaphore to
+    ensure none of them is still generating; that also keeps concurrent
+    calls from worker threads off the model cache.
+    """
     if model_id not in MODEL_CONFIGS:
         raise ValueError(f"Unknown model: {model_id}")
     
     if model_id in loaded_models:
+        loaded_models.move_to_end(model_id)
         return loaded_models[model_id]
     
     try:
+        from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer
+        from moeviz.model_adapters import get_model_adapter
+        
         model_name = MODEL_CONFIGS[model_id]["path"]
+        quantization = MODEL_CONFIGS[model_id].get("quantization", QUANTIZATION)
+        # Resolve what can fail cheaply before evicting, so a bad setting or
+        # unreachable checkpoint does not also unload the cached models
+        quantization_config = get_quantization_config(quantization)
+        AutoConfig.from_pretrained(model_name)
+        tokenizer = AutoTokenizer.from_pretrained(model_name)
+        
+        # Make room first so the old and new weights are never resident together
+        evict_models(max(MAX_LOADED_MODELS - 1, 0))
+        
         model = AutoModelForCausalLM.from_pretrained(
             model_name,
             torch_dtype="auto",
-            device_map="auto"
+            device_map="auto",
+            attn_implementation=ATTN_IMPLEMENTATION,
+            quantization_config=quantization_config
         )
-        tokenizer = AutoTokenizer.from_pretrained(model_name)
+        # Pre-tokenize the chat template and compile the router kernels now
+        # rather than on the first request
+        get_prompt_template(model_id, tokenizer)
+        try:
+            get_model_adapter(MODEL_CONFIGS[model_id]).warmup(model.device, model.dtype)
+        except Exception as e:
+            # Only an optimization; the kernels compile on first use instead
+            print(f"Router warmup failed for {model_id}: {e}")
         loaded_models[model_id] = (model, tokenizer)
         return loaded_models[model_id]
     except Exception as e:
@@ -86,7 +274,101 @@ def load_model(model_id):
         return None
 
 
-# These functions are now provided by the model adapters in model_adapters.py
+def build_messages(model_config, prompt):
+    """Build the chat messages for a prompt, with a model-specific system message."""
+    messages = []
+    # We use a system message appropriate for the model type, with fallback to a generic one
+    if model_config.get('model_type') == 'qwen':
+        system_content = "You are Qwen, created by Alibaba Cloud. You are a helpful assistant."
+        messages.append({"role": "system", "content": system_content})
+    messages.append({"role": "user", "content": prompt})
+    return messages
+
+
+def render_prompt(tokenizer, model_config, prompt):
+    """Render a prompt through the tokenizer's chat template."""
+    # Apply chat template - handle differences between models
+    try:
+        return tokenizer.apply_chat_template(
+            build_messages(model_config, prompt),
+            tokenize=False,
+            add_generation_prompt=True
+        )
+    except Exception as e:
+        print(f"Error applying chat template: {e}")
+        # Fallback to simpler prompt
+        return f"<s>[INST] {prompt} [/INST]"
+
+
+PROMPT_PLACEHOLDER = "\x00moeviz-prompt\x00"
+
+# model_id -> (prefix_ids, suffix_ids) as (1, n) tensors, or None if the
+# template cannot be split
+prompt_templates = {}
+
+def get_prompt_template(model_id, tokenizer):
+    """Return the token ids the chat template places around the user prompt.
+    
+    The template is rendered once per model with a placeholder prompt and the
+    text on either side of it is tokenized and cached, so requests only need
+    to tokenize the prompt itself. Returns None when the template does not
+    contain the prompt exactly once, or when splitting it would not reproduce
+    the tokenization of the fully rendered prompt.
+    """
+    if model_id in prompt_templates:
+        return prompt_templates[model_id]
+    
+    import torch
+    model_config = MODEL_CONFIGS[model_id]
+    parts = render_prompt(tokenizer, model_config, PROMPT_PLACEHOLDER).split(PROMPT_PLACEHOLDER)
+    if len(parts) != 2:
+        print(f"Chat template for {model_id} does not contain the prompt once, rendering per request")
+        prompt_templates[model_id] = None
+        return None
+    prefix, suffix = parts
+    # Built explicitly as long so an empty prefix or suffix keeps the dtype
+    prefix_ids = torch.tensor([tokenizer.encode(prefix, add_special_tokens=False)], dtype=torch.long)
+    suffix_ids = torch.tensor([tokenizer.encode(suffix, add_special_tokens=False)], dtype=torch.long)
+    
+    # Tokens can merge across the prompt boundary, so check a sample prompt
+    sample = "Hello, world."
+    expected = tokenizer.encode(render_prompt(tokenizer, model_config, sample), add_special_tokens=False)
+    sample_ids = tokenizer.encode(sample, add_special_tokens=False)
+    if prefix_ids[0].tolist() + sample_ids + suffix_ids[0].tolist() != expected:
+        print(f"Chat template for {model_id} cannot be pre-tokenized, rendering per request")
+        prompt_templates[model_id] = None
+    else:
+        prompt_templates[model_id] = (prefix_ids, suffix_ids)
+    return prompt_templates[model_id]
+
+
+def build_model_inputs(model_id, model, tokenizer, prompt):
+    """Tokenize a prompt into generate() inputs on the model's device."""
+    import torch
+    # Reuse the pre-tokenized chat template if possible. Whitespace at either
+    # end of the prompt can merge with the template text around it (e.g. a
+    # leading newline joining the one after the role), which the sample check
+    # in get_prompt_template cannot rule out, so such prompts are rendered
+    template = get_prompt_template(model_id, tokenizer)
+    if template is not None and prompt and prompt == prompt.strip():
+        prefix_ids, suffix_ids = template
+        prompt_ids = torch.tensor([tokenizer.encode(prompt, add_special_tokens=False)], dtype=torch.long)
+        input_ids = torch.cat([prefix_ids, prompt_ids, suffix_ids], dim=1).to(model.device)
+        return {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)}
+    
+    text = render_prompt(tokenizer, MODEL_CONFIGS[model_id], prompt)
+    return tokenizer([text], return_tensors="pt").to(model.device)
+
+
+async def stream_generated_text(streamer, request_id, sid):
+    """Emit text chunks to the requesting client as generation produces them."""
+    while True:
+        # The streamer blocks until the next chunk, so wait on a worker thread
+        text = await asyncio.to_thread(next, streamer, None)
+        if text is None:
+            return
+        if text and sid is not None:
+            await sio.emit('generated_text', {"request_id": request_id, "text": text}, to=sid)
 
 
 @sio.event
@@ -101,16 +383,37 @@ async def disconnect(sid):
 async def generate_text(request: GenerateRequest):
     prompt = request.prompt
     model_id = request.model
+    request_id = request.request_id or uuid.uuid4().hex
     print(f"Received prompt: {prompt}")
     
-    # Clean up any tokens in the queue
-    while not tokens_queue.empty():
-        tokens_queue.get()
+    # Loading may evict other models, so it shares the admission slot with
+    # generation and never unloads a model that is still generating. The
+    # model is only referenced inside generate_with_model, so those
+    # references are gone by the time the slot is released
+    async with generation_semaphore:
+        result = await generate_with_model(model_id, prompt, request_id, request.sid)
+    if "error" in result:
+        return result
+
+    # Notify client that generation is complete
+    if request.sid is not None:
+        await sio.emit('generation_complete', {"request_id": request_id}, to=request.sid)
     
-    # Load the model and tokenizer
-    model, tokenizer = load_model(model_id)
-    if not model or not tokenizer:
+    return result
+
+
+async def generate_with_model(model_id, prompt, request_id, sid):
+    """Load a model and run one generation; the caller holds generation_semaphore."""
+    import torch
+    from transformers import TextIteratorStreamer
+    from moeviz.model_adapters import get_model_adapter
+    
+    # Load the model and tokenizer off the event loop; loading also renders the
+    # chat template and warms up the router kernels
+    loaded = await asyncio.to_thread(load_model, model_id)
+    if loaded is None:
         return {"error": f"Failed to load model {model_id}"}
+    model, tokenizer = loaded
     
     # Get the model config
     model_config = MODEL_CONFIGS.get(model_id, {})
@@ -119,71 +422,65 @@ async def generate_text(request: GenerateRequest):
     
     # Get the appropriate adapter for this model
     try:
-        adapter = get_model_adapter(model_config)
+        adapter = get_model_adapter(model_config, include_prompt=ROUTE_PROMPT_TOKENS,
+                                    flush_steps=ROUTING_FLUSH_STEPS)
     except ValueError as e:
         return {"error": str(e)}
     
     # Layer to monitor (currently just using the first layer)
     layer_id = 0
     
-    # Register hooks using the adapter
-    hooks = adapter.register_hooks(model, layer_id, tokens_queue, routing_queue, tokenizer)
-    
-    # Prepare the prompt
-    # We use a system message appropriate for the model type, with fallback to a generic one
-    use_system_prompt = False
-    system_content = ""
-    if model_config.get('model_type') == 'qwen':
-        system_content = "You are Qwen, created by Alibaba Cloud. You are a helpful assistant."
-        use_system_prompt = True
+    # Tokenize off the event loop so routing updates keep flowing meanwhile
+    model_inputs = await asyncio.to_thread(build_model_inputs, model_id, model, tokenizer, prompt)
     
-    messages = []
-    if use_system_prompt:
-        messages.append({"role": "system", "content": system_content})
-    messages.append({"role": "user", "content": prompt})
-        
-    # Apply chat template - handle differences between models
-    try:
-        text = tokenizer.apply_chat_template(
-            messages,
-            tokenize=False,
-            add_generation_prompt=True
-        )
-    except Exception as e:
-        print(f"Error applying chat template: {e}")
-        # Fallback to simpler prompt
-        text = f"<s>[INST] {prompt} [/INST]"
-    
-    # Tokenize input and prepare for generation
-    model_inputs = tokenizer([text], return_tensors="pt").to(model.device)
+    streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
     
     def run_generation():
-        return model.generate(
-            **model_inputs,
-            max_new_tokens=MAX_NEW_TOKENS
-        )
+        try:
+            # Also covers the forward hooks' tensor ops
+            with torch.inference_mode():
+                return model.generate(
+                    **model_inputs,
+                    max_new_tokens=MAX_NEW_TOKENS,
+                    streamer=streamer
+                )
+        except Exception:
+            # Unblock stream_generated_text, which would otherwise wait forever
+            streamer.end()
+            raise
+
+    # Per-request state, so concurrent requests never share hook queues.
+    # Token and router hooks both run on the generation thread, so a plain
+    # deque suffices; bounded so an abandoned generation cannot grow it
+    tokens_queue = deque(maxlen=4096)
+    routing_writer = RequestRoutingWriter(routing_buffer, request_id, sid, tokenizer)
 
-    # Prevent blocking of event loop
     try:
-        generated_ids = await asyncio.get_event_loop().run_in_executor(
-            thread_pool,
-            run_generation
-        )
+        # Compile the router before hooking it; hooks go on the compiled wrapper
+        if COMPILE_ROUTER:
+            adapter.compile_router(model, layer_id)
+        
+        # Hooks are only attached while this request is generating
+        with adapter.hooks_registered(model, layer_id, tokens_queue, routing_writer):
+            # Prevent blocking of event loop
+            generation = asyncio.get_event_loop().run_in_executor(
+                thread_pool,
+                run_generation
+            )
+            try:
+                await stream_generated_text(streamer, request_id, sid)
+            finally:
+                # Even if streaming fails or the request is cancelled, keep the
+                # hooks and the admission slot until the worker thread is done
+                # with the model; wait() does not cancel the generation
+                await asyncio.wait([generation])
+            generated_ids = generation.result()
         generated_text = tokenizer.decode(generated_ids[0], skip_special_tokens=True)
     except Exception as e:
         print(f"Generation error: {e}")
-        for hook in hooks:
-            hook.remove()
         return {"error": f"Generation failed: {str(e)}"}
-
-    # Notify client that generation is complete
-    await sio.emit('generation_complete')
-    
-    # Remove hooks
-    for hook in hooks:
-        hook.remove()
     
-    return {"message": generated_text}
+    return {"message": generated_text, "request_id": request_id}
 
 
 @app.get("/config")
@@ -192,4 +489,6 @@ async def get_config():
     return get_client_config()
 
 if __name__ == "__main__":
+    # loop/http default to "auto", which picks uvloop and httptools from
+    # uvicorn[standard] where available and falls back to asyncio/h11
     uvicorn.run(app, host=SERVER_HOST, port=SERVER_PORT)
\ No newline at end of file